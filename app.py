@@ -1,43 +1,200 @@
 import os
-import io
+import re
 import json
-import time
+import asyncio
+import hashlib
 import logging
 import uvicorn
+import aiofiles
+import numpy as np
 from PIL import Image
 from typing import List
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
+from functools import lru_cache
 from furniture import Util, FurnitureRepository, Furniture
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from concurrent.futures import ThreadPoolExecutor
 
-app = FastAPI(title="Furniture Search API")
+# orjson serializes the large hit payloads 3-10x faster than stdlib json
+app = FastAPI(title="Furniture Search API", default_response_class=ORJSONResponse)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Compiled once; the sub() runs in C instead of a per-char Python loop
+_SAFE_FN_RE = re.compile(r"[^A-Za-z0-9._-]")
+
+# Stem shape of content-addressed uploads (sha256 digest prefix from
+# save_upload_image); only those names are safe to cache forever.
+_DIGEST_NAME_RE = re.compile(r"^[0-9a-f]{16}$")
+
 STATIC_DIR = "static"
 UPLOAD_DIR = os.path.join(STATIC_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 es = Util.get_connection()
 INDEX = Util.get_index_name()
-repo = FurnitureRepository(es, INDEX)
+repo = FurnitureRepository(es, INDEX, create=True)  # create-if-missing, never wipes
+
+# Bounded pool for model.encode so the torch forward pass never blocks the
+# event loop, and at most two encodes run at once instead of thrashing the model.
+EMBED_POOL = ThreadPoolExecutor(max_workers=2)
+
+# Micro-batching for model.encode: concurrent requests enqueue their payload
+# (PIL image or query string) and a single worker coalesces them into one
+# batched forward pass instead of K serial ones.
+MAX_BATCH = 32
+BATCH_WINDOW_SECONDS = 0.01
+
+class EmbeddingBatcher:
+    def __init__(self, encode_fn, max_batch: int = MAX_BATCH, window: float = BATCH_WINDOW_SECONDS):
+        self.encode_fn = encode_fn
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._worker())
+
+    async def submit(self, payload):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((payload, future))
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(items) < self.max_batch and loop.time() < deadline:
+                try:
+                    items.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0.001)
+
+            payloads = [p for p, _ in items]
+            try:
+                vectors = await loop.run_in_executor(
+                    EMBED_POOL,
+                    lambda: self.encode_fn(
+                        payloads,
+                        batch_size=self.max_batch,
+                        normalize_embeddings=True,
+                    ),
+                )
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), vec in zip(items, vectors):
+                if not future.done():
+                    future.set_result(vec)
+
+batcher = EmbeddingBatcher(Furniture.encode)
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
+
+# Stored mustache template for plain kNN searches: ES parses the query shape
+# once, and each request ships only the parameter dict instead of rebuilding
+# (and re-parsing) the nested body.
+KNN_TEMPLATE_ID = "knn_search_tmpl"
+
+# Raw source, not json.dumps: the {{#toJson}} section must sit outside JSON
+# quotes so the vector renders as an array rather than a quoted string. The
+# rescore_vector clause matches repo.search_by_knn so the template and
+# fallback paths rank identically after int8 quantization.
+RESCORE_OVERSAMPLE = 10.0
+
+KNN_TEMPLATE_SOURCE = (
+    '{'
+    '"size": {{k}},'
+    '"_source": {"excludes": ["image_embedding", "text_embedding"]},'
+    '"knn": {'
+    '"field": "{{field}}",'
+    '"query_vector": {{#toJson}}vector{{/toJson}},'
+    '"k": {{k}},'
+    '"num_candidates": {{nc}},'
+    '"rescore_vector": {"oversample": {{oversample}}}'
+    '}'
+    '}'
+)
+
+# Flipped on only after the template registers AND renders; search_template
+# is skipped entirely while this is False instead of failing per request.
+_knn_template_ready = False
+
+@app.on_event("startup")
+async def register_search_templates():
+    global _knn_template_ready
+    try:
+        await asyncio.to_thread(
+            es.put_script,
+            id=KNN_TEMPLATE_ID,
+            body={"script": {"lang": "mustache", "source": KNN_TEMPLATE_SOURCE}},
+        )
+        # Prove the template expands to a valid body before trusting it on
+        # the request path.
+        await asyncio.to_thread(
+            es.render_search_template,
+            id=KNN_TEMPLATE_ID,
+            params={
+                "field": "image_embedding",
+                "vector": [0.0, 1.0],
+                "k": 1,
+                "nc": 10,
+                "oversample": RESCORE_OVERSAMPLE,
+            },
+        )
+        _knn_template_ready = True
+        logger.info(f"Registered search template: {KNN_TEMPLATE_ID}")
+    except Exception as e:
+        logger.warning(f"Failed to register kNN search template: {e}")
+
+# JPEG decode takes tens of ms on multi-MB uploads; keep it off the event
+# loop. PIL reads straight from the upload's SpooledTemporaryFile, so the
+# whole payload is never materialized as a bytes object. Hosts that can
+# build pillow-simd (see requirements.txt) vectorize the decode itself.
+async def _decode_upload(upload: UploadFile) -> Image.Image:
+    def _open():
+        upload.file.seek(0)
+        return Image.open(upload.file).convert("RGB")
+    return await asyncio.to_thread(_open)
+
+def _hash_upload(f) -> str:
+    f.seek(0)
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+        h.update(chunk)
+    return h.hexdigest()
 
 async def save_upload_image(upload: UploadFile) -> str:
-    contents = await upload.read()  # use async read
     try:
-        img = Image.open(io.BytesIO(contents)).convert("RGB")
+        img = await _decode_upload(upload)  # validates the image
     except Exception as e:
         raise HTTPException(400, f"Invalid image: {e}")
 
-    safe_name = "".join(c if c.isalnum() or c in "._-" else "_" for c in upload.filename)
+    # Content-addressed name: identical uploads dedup to a single file, and
+    # the digest doubles as a strong ETag in serve_upload below.
+    digest = await asyncio.to_thread(_hash_upload, upload.file)
+    ext = os.path.splitext(_SAFE_FN_RE.sub("_", upload.filename or ""))[1].lower() or ".jpg"
+    safe_name = f"{digest[:16]}{ext}"
     rel_path = f"uploads/{safe_name}"           # ← relative path
     abs_path = os.path.join(UPLOAD_DIR, safe_name)
 
-    img.save(abs_path)
-    print(f"Saved image: {abs_path}")
+    if not os.path.exists(abs_path):
+        # The spooled upload already holds a valid image; stream it to disk
+        # through aiofiles instead of blocking the loop on the write/fsync.
+        upload.file.seek(0)
+        async with aiofiles.open(abs_path, "wb") as fh:
+            while chunk := upload.file.read(1 << 20):
+                await fh.write(chunk)
+        print(f"Saved image: {abs_path}")
 
     return rel_path
 
@@ -49,12 +206,24 @@ def get_dynamic_terms(fields=["colors", "item_type"]):
         body={"aggs": aggs}
     )
     
+    # frozensets: token membership checks in search_by_text are O(1) instead
+    # of a linear scan over up to 1000 terms, and lowercasing happens once
+    # here rather than on every request.
     results = {}
     for f in fields:
         buckets = resp["aggregations"].get(f"{f}_agg", {}).get("buckets", [])
-        results[f] = [b["key"].lower() for b in buckets]
+        results[f] = frozenset(b["key"].lower() for b in buckets)
     return results
 
+# Popular queries repeat constantly (autocomplete, retried searches); memoize
+# the transformer pass so a cache hit is a dict lookup instead of a forward pass.
+# Keys are normalized (strip + lower) so whitespace variants share an entry.
+@lru_cache(maxsize=4096)
+def _encode_text(q: str) -> tuple:
+    return tuple(
+        Furniture.encode(q, normalize_embeddings=True).astype(np.float32, copy=False).tolist()
+    )
+
 @app.get("/")
 async def serve_ui():
     return FileResponse("static/index.html")
@@ -91,7 +260,8 @@ async def add_item(
         media_gallery=[{"file": image_path, "media_type": "image"}],
     )
 
-    repo.insert(furniture)
+    # insert() runs generate_embeddings(); keep that forward pass off the event loop
+    await asyncio.get_running_loop().run_in_executor(EMBED_POOL, repo.insert, furniture)
 
     return {
         "status": "ok",
@@ -100,42 +270,50 @@ async def add_item(
         "image_path": image_path,
     }
 
-# Simple in-memory cache for dynamic terms
-DYNAMIC_TERMS_CACHE = {"colors": [], "item_type": []}
-DYNAMIC_TERMS_LAST_FETCH = 0
+# Simple in-memory cache for dynamic terms, refreshed entirely off the
+# request path by a background task so searches never block on the aggregation.
+DYNAMIC_TERMS_CACHE = {"colors": frozenset(), "item_type": frozenset()}
 CACHE_TTL_SECONDS = 300  # refresh every 5 minutes
 
+async def _refresh_terms_loop():
+    global DYNAMIC_TERMS_CACHE
+    while True:
+        try:
+            DYNAMIC_TERMS_CACHE = await asyncio.to_thread(
+                get_dynamic_terms, ["colors", "item_type"]
+            )
+            logger.info(f"Dynamic terms cache refreshed: {DYNAMIC_TERMS_CACHE}")
+        except Exception as e:
+            logger.warning(f"Dynamic terms refresh failed: {e}")
+        await asyncio.sleep(CACHE_TTL_SECONDS)
+
+# The loop only holds a weak reference to tasks, so keep a strong one here
+# or the refresher can be garbage-collected mid-run.
+_terms_refresh_task = None
+
+@app.on_event("startup")
+async def start_terms_refresher():
+    global _terms_refresh_task
+    _terms_refresh_task = asyncio.create_task(_refresh_terms_loop())
+
 @app.get("/search/text")
-async def search_by_text(q: str, k: int = 5):
+async def search_by_text(q: str, k: int = 5, num_candidates: int | None = None):
     if not q:
         raise HTTPException(400, "Missing query parameter 'q'")
 
-    global DYNAMIC_TERMS_CACHE, DYNAMIC_TERMS_LAST_FETCH
-    now = time.time()
-    if now - DYNAMIC_TERMS_LAST_FETCH > CACHE_TTL_SECONDS or not DYNAMIC_TERMS_CACHE["colors"]:
-        DYNAMIC_TERMS_CACHE = get_dynamic_terms(fields=["colors", "item_type"])
-        DYNAMIC_TERMS_LAST_FETCH = now
-        logger.info(f"Dynamic terms cache refreshed: {DYNAMIC_TERMS_CACHE}")
-
-    colors_list = [c.lower() for c in DYNAMIC_TERMS_CACHE.get("colors", [])]
-    item_types_list = [t.lower() for t in DYNAMIC_TERMS_CACHE.get("item_type", [])]
-
-    logger.info(f"Colors list (lowercased): {colors_list}")
-    logger.info(f"Item types list (lowercased): {item_types_list}")
+    colors_set = DYNAMIC_TERMS_CACHE.get("colors", frozenset())
+    types_set = DYNAMIC_TERMS_CACHE.get("item_type", frozenset())
 
     tokens = q.split()
     tokens_lower = [t.lower() for t in tokens]
 
-    logger.info(f"Query tokens: {tokens}")
-    logger.info(f"Query tokens lowercased: {tokens_lower}")
+    logger.debug("Query tokens: %s (lowercased: %s)", tokens, tokens_lower)
 
-    color_tokens = [t for t in tokens_lower if t in colors_list]
-    type_tokens = [t for t in tokens_lower if t in item_types_list]
-    other_tokens = [t for t in tokens_lower if t not in color_tokens + type_tokens]
+    color_tokens = [t for t in tokens_lower if t in colors_set]
+    type_tokens = [t for t in tokens_lower if t in types_set]
+    other_tokens = [t for t in tokens_lower if t not in colors_set and t not in types_set]
 
-    logger.info(f"Identified color tokens: {color_tokens}")
-    logger.info(f"Identified item_type tokens: {type_tokens}")
-    logger.info(f"Other tokens: {other_tokens}")
+    logger.debug("Token split: colors=%s types=%s other=%s", color_tokens, type_tokens, other_tokens)
 
     should_clauses = []
 
@@ -146,7 +324,7 @@ async def search_by_text(q: str, k: int = 5):
                 "boost": 10.0
             }
         })
-        logger.info(f"Added item_type terms clause: {type_tokens}")
+        logger.debug("Added item_type terms clause: %s", type_tokens)
 
     if color_tokens:
         should_clauses.append({
@@ -155,7 +333,7 @@ async def search_by_text(q: str, k: int = 5):
                 "boost": 6.0
             }
         })
-        logger.info(f"Added colors terms clause: {color_tokens}")
+        logger.debug("Added colors terms clause: %s", color_tokens)
 
     if other_tokens or tokens:
         should_clauses.append({
@@ -173,10 +351,22 @@ async def search_by_text(q: str, k: int = 5):
                 "boost": 3.0
             }
         })
-        logger.info("Added fuzzy multi_match clause for free-text search")
-
-    query_body = {
+        logger.debug("Added fuzzy multi_match clause for free-text search")
+
+    # Lexical BM25 retrieval and dense retrieval over the description
+    # embeddings go out as one msearch, so ES runs them in parallel and we
+    # pay a single round-trip. The encode is memoized, so repeated queries
+    # skip the transformer entirely; cache misses run the forward pass on
+    # EMBED_POOL so the event loop never blocks on it.
+    query_vector = list(
+        await asyncio.get_running_loop().run_in_executor(
+            EMBED_POOL, _encode_text, q.strip().lower()
+        )
+    )
+    excludes = {"excludes": ["image_embedding", "text_embedding"]}
+    lexical_body = {
         "size": k,
+        "_source": excludes,
         "query": {
             "bool": {
                 "should": should_clauses,
@@ -184,19 +374,44 @@ async def search_by_text(q: str, k: int = 5):
             }
         }
     }
+    dense_body = {
+        "size": k,
+        "_source": excludes,
+        "knn": {
+            "field": "text_embedding",
+            "query_vector": query_vector,
+            "k": k,
+            "num_candidates": num_candidates or max(50, 10 * k)
+        }
+    }
+    msearch_body = [
+        {"index": INDEX}, lexical_body,
+        {"index": INDEX}, dense_body,
+    ]
 
-    # Pretty-print the query
-    logger.info("Final Elasticsearch query:\n%s", json.dumps(query_body, indent=4))
+    # Pretty-printing the body costs hundreds of us; only do it when someone
+    # is actually reading DEBUG logs.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Final Elasticsearch msearch:\n%s", json.dumps(msearch_body, indent=4))
 
-    resp = es.search(index=INDEX, body=query_body)
-    hits = resp.get("hits", {}).get("hits", [])
+    resp = es.msearch(body=msearch_body)
+
+    # Reciprocal rank fusion across the two hit lists
+    RRF_K = 60
+    fused = {}
+    for r in resp.get("responses", []):
+        for rank, h in enumerate(r.get("hits", {}).get("hits", [])):
+            entry = fused.setdefault(h["_id"], {"hit": h, "score": 0.0})
+            entry["score"] += 1.0 / (RRF_K + rank + 1)
 
-    logger.info(f"Number of hits: {len(hits)}")
+    merged = sorted(fused.values(), key=lambda e: e["score"], reverse=True)[:k]
+
+    logger.debug("Number of fused hits: %s", len(merged))
 
     return {
         "results": [
-            {**h["_source"], "_score": h["_score"]}
-            for h in hits
+            {**e["hit"]["_source"], "_score": e["score"]}
+            for e in merged
         ]
     }
 
@@ -242,43 +457,46 @@ async def suggest_text(q: str):
         return {"did_you_mean": None}
 
 MIN_SIMILARITY = 0.7
-CANDIDATE_K = 50
-
-@app.post("/search/image")
-async def search_by_image(image: UploadFile = File(...), k: int = 5):
-    try:
-        contents = await image.read()
-        img = Image.open(io.BytesIO(contents)).convert("RGB")
-    except Exception as e:
-        raise HTTPException(400, f"Invalid image: {e}")
 
-    # IMPORTANT: normalize embeddings
-    vector = (
-        Furniture.model.encode(img, normalize_embeddings=True)
-        .astype(float)
-        .tolist()
-    )
+# Users re-upload the same reference image many times (UI debugging,
+# iterative search); cache embeddings keyed by the SHA-256 of the raw upload
+# bytes so exact duplicates skip the encoder entirely.
+IMAGE_EMBED_CACHE = {}
+IMAGE_EMBED_CACHE_SIZE = 1024
 
-    # Step 1: retrieve candidates
+@app.post("/search/image")
+async def search_by_image(
+    image: UploadFile = File(...),
+    k: int = 5,
+    num_candidates: int | None = None,
+):
+    digest = await asyncio.to_thread(_hash_upload, image.file)
+    vector = IMAGE_EMBED_CACHE.get(digest)
+    if vector is None:
+        try:
+            img = await _decode_upload(image)
+        except Exception as e:
+            raise HTTPException(400, f"Invalid image: {e}")
+
+        # IMPORTANT: embeddings come back normalized from the batcher
+        vector = (await batcher.submit(img)).astype(np.float32, copy=False).tolist()
+        if len(IMAGE_EMBED_CACHE) >= IMAGE_EMBED_CACHE_SIZE:
+            IMAGE_EMBED_CACHE.pop(next(iter(IMAGE_EMBED_CACHE)))
+        IMAGE_EMBED_CACHE[digest] = vector
+
+    # ES oversamples quantized candidates and reranks the top k exactly,
+    # so we ask for k directly instead of pulling back a candidate pool.
+    # ES applies the similarity threshold via min_score and returns hits
+    # already sorted, so there is nothing left to filter app-side.
     resp = repo.search_by_knn(
         field="image_embedding",
         vector=vector,
-        k=CANDIDATE_K
+        k=k,
+        num_candidates=num_candidates,
+        min_score=MIN_SIMILARITY
     )
 
-    hits = resp.get("hits", {}).get("hits", [])
-
-    # Step 2: filter by similarity threshold
-    filtered_hits = [
-        h for h in hits
-        if h.get("_score", 0) >= MIN_SIMILARITY
-    ]
-
-    # Step 3: sort by score (descending)
-    filtered_hits.sort(key=lambda h: h["_score"], reverse=True)
-
-    # Step 4: limit to requested k
-    final_hits = filtered_hits[:k]
+    final_hits = resp.get("hits", {}).get("hits", [])
 
     # Optional: reject low-confidence searches entirely
     if not final_hits:
@@ -301,15 +519,69 @@ async def search_by_image(image: UploadFile = File(...), k: int = 5):
 async def search_by_embedding(
     embedding: List[float],
     field: str = "image_embedding",
-    k: int = 5
+    k: int = 5,
+    num_candidates: int | None = None
 ):
     if field not in ("image_embedding", "text_embedding"):
         raise HTTPException(400, "Invalid embedding field")
 
-    resp = repo.search_by_knn(field, embedding, k=k)
+    global _knn_template_ready
+    if _knn_template_ready:
+        # The candidate pool must cover the oversampled rescore window.
+        nc = max(num_candidates or 0, int(k * RESCORE_OVERSAMPLE), 50)
+        try:
+            resp = es.search_template(
+                index=INDEX,
+                body={
+                    "id": KNN_TEMPLATE_ID,
+                    "params": {
+                        "field": field,
+                        "vector": embedding,
+                        "k": k,
+                        "nc": nc,
+                        "oversample": RESCORE_OVERSAMPLE,
+                    },
+                },
+            )
+        except Exception as e:
+            # The template rendered at startup, so a failure here means the
+            # stored script went bad; stop paying a doomed round-trip on
+            # every subsequent request.
+            _knn_template_ready = False
+            logger.warning(f"search_template failed, disabling template path: {e}")
+            resp = repo.search_by_knn(field, embedding, k=k, num_candidates=num_candidates)
+    else:
+        resp = repo.search_by_knn(field, embedding, k=k, num_candidates=num_candidates)
     hits = resp.get("hits", {}).get("hits", [])
     return {"results": [h.get("_source", {}) for h in hits]}
 
 
+@app.get("/static/uploads/{filename}")
+async def serve_upload(filename: str):
+    if filename != _SAFE_FN_RE.sub("_", filename):
+        raise HTTPException(404, "Not found")
+    path = os.path.join(UPLOAD_DIR, filename)
+    if not os.path.isfile(path):
+        raise HTTPException(404, "Not found")
+
+    # Only API uploads are content-addressed; for those the name is a strong
+    # validator and clients can cache forever. Importer downloads keep their
+    # CDN basenames and get overwritten in place when the remote changes, so
+    # they are served with the default stat-based validators instead.
+    stem = os.path.splitext(filename)[0]
+    if _DIGEST_NAME_RE.match(stem):
+        return FileResponse(path, headers={
+            "ETag": f'"{stem}"',
+            "Cache-Control": "public, max-age=31536000, immutable",
+        })
+    return FileResponse(path)
+
+# Mounted after the routes so /static/uploads/* resolves to serve_upload first
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # One worker means one GIL and one embedding request at a time; scale to
+    # the machine (override with WEB_CONCURRENCY, e.g. =1 while developing).
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=workers)
\ No newline at end of file
@@ -1,8 +1,16 @@
 import os
-import time
 import shutil
+import orjson
+import tempfile
+import argparse
 import requests
+import posixpath
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from selectolax.parser import HTMLParser
 from dotenv import load_dotenv
 from furniture import Util, Furniture, FurnitureRepository
 
@@ -22,20 +30,57 @@ INDEX = Util.get_index_name()
 
 # ---------- Elasticsearch setup ----------
 es = Util.get_connection()
-repo = FurnitureRepository(es, INDEX, force=True)  # Recreates index
+repo = FurnitureRepository(es, INDEX)
+
+
+# ---------- HTTP session for image downloads ----------
+# Downloads are latency-bound; the GIL is released during socket I/O so
+# threads overlap cleanly up to the CDN's per-host concurrency cap.
+DOWNLOAD_WORKERS = 16
+
+# One pooled session for the whole import: images come from a handful of CDN
+# hosts, so keep-alive reuses the TCP+TLS connection instead of paying a
+# fresh handshake per image.
+_IMG_SESSION = requests.Session()
+_IMG_SESSION.headers["Connection"] = "keep-alive"
+# urllib3 handles retries at transport level: exponential backoff, only on
+# connection errors and 429/5xx (4xx fail immediately), with jitter where
+# supported (urllib3 >= 2).
+_retry_kwargs = dict(
+    total=3,
+    backoff_factor=1.0,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["GET"]),
+)
+try:
+    _img_retry = Retry(backoff_jitter=0.5, **_retry_kwargs)
+except TypeError:  # urllib3 < 2 has no backoff_jitter
+    _img_retry = Retry(**_retry_kwargs)
+# pool_maxsize tracks the executor width (x2 headroom for redirects and the
+# --workers override) so no download thread ever spills past the pool and
+# re-handshakes; a handful of distinct hosts is plenty for one CDN.
+_img_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=DOWNLOAD_WORKERS * 2,
+    max_retries=_img_retry,
+)
+_IMG_SESSION.mount("https://", _img_adapter)
+_IMG_SESSION.mount("http://", _img_adapter)
 
 
 # ---------- Helper ----------
-def get_attribute_value(product, label):
-    for attr in product.get("attributes", []):
-        if attr.get("frontend_label") == label:
-            value = attr.get("value", "").strip()
-            return value if value else ""
-    return ""
+def _attr_map(product):
+    # One pass over the attribute list; the import loop looks up five
+    # labels per product, so a dict beats repeated linear scans.
+    return {
+        attr.get("frontend_label"): (attr.get("value") or "").strip()
+        for attr in product.get("attributes", [])
+        if attr.get("frontend_label")
+    }
 
 
 # ---------- Fetch products ----------
-def fetch_products():
+def fetch_products(pages=2):
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
@@ -50,7 +95,7 @@ def fetch_products():
     all_items = []
 
     try:
-        for page in range(1, 3):
+        for page in range(1, pages + 1):
             payload = {
                 "currentPage": page,
                 "pageSize": 100,
@@ -61,7 +106,9 @@ def fetch_products():
             print(f"Requesting products (page {page})...")
             response = session.post(PRODUCT_SEARCH_ENDPOINT, json=payload, timeout=120)
             response.raise_for_status()
-            data = response.json()
+            # The feed is a multi-MB JSON body (nested HTML descriptions);
+            # orjson parses it in C straight from the raw bytes.
+            data = orjson.loads(response.content)
 
             items = data.get("data", {}).get("products", {}).get("items", [])
             print(f"Fetched {len(items)} products from page {page}")
@@ -69,7 +116,7 @@ def fetch_products():
             all_items.extend(items)
 
             # Stop early if fewer than pageSize items returned
-            if len(items) < 500:
+            if len(items) < payload["pageSize"]:
                 print("No more pages available. Stopping early.")
                 break
 
@@ -80,65 +127,106 @@ def fetch_products():
         print(f"Error fetching products: {e}")
         return all_items
 
+_IMG_EXTS = frozenset({"jpg", "jpeg", "png", "webp"})
+
+
 # ---------- Download ONLY the main original image ----------
-def download_main_image(product, retries=3):
-    main_image_url = product.get("image", {}).get("url")
+def _main_image_url(product):
+    return product.get("image", {}).get("url") or ""
+
+
+def _dest_filename(url):
+    # urlparse drops the query string properly (Path(...).name would keep a
+    # fragment of it) and basename avoids the intermediate Path object.
+    base = posixpath.basename(urlparse(url).path)
+    ext = base.rpartition(".")[2].lower()
+    return base if ext in _IMG_EXTS else base + ".jpg"
+
+
+def _need_download(url, dest):
+    # A bare exists() check treats files truncated by a killed prior run as
+    # complete. A HEAD request is a headers-only round-trip; compare the
+    # advertised size against what's on disk.
+    if not dest.exists():
+        return True
+    try:
+        h = _IMG_SESSION.head(url, timeout=10, allow_redirects=True)
+        remote_size = int(h.headers.get("Content-Length", 0))
+    except (requests.RequestException, ValueError):
+        return False  # can't verify; keep the cached file
+    return remote_size > 0 and dest.stat().st_size != remote_size
+
+
+def download_image(main_image_url):
     if not main_image_url:
         return ""
 
-    # Clean filename
-    dest_filename = Path(main_image_url).name.split("?")[0]
-    if not dest_filename.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-        dest_filename += ".jpg"
-
+    dest_filename = _dest_filename(main_image_url)
     dest_path = UPLOAD_DIR / dest_filename
 
-    if not dest_path.exists():
-        attempt = 0
-        while attempt <= retries:
-            try:
-                r = requests.get(main_image_url, stream=True, timeout=30)
-                r.raise_for_status()
-                with open(dest_path, "wb") as f:
-                    shutil.copyfileobj(r.raw, f)
-                # print(f"Downloaded main image: {dest_path}")
-                break
-            except Exception as e:
-                attempt += 1
-                if attempt > retries:
-                    print(f"Failed to download {main_image_url}: {e}")
-                else:
-                    time.sleep(2 ** attempt)
+    if _need_download(main_image_url, dest_path):
+        # Write to a uniquely named temp file and rename on success, so a
+        # killed process never leaves a truncated image behind the
+        # exists()/size check. The name must be unique per download: two
+        # URLs differing only in query params share a basename, and with
+        # parallel workers a fixed .part name would be written by both.
+        tmp = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix=".part", delete=False)
+        try:
+            # Retries/backoff happen in the mounted adapter; anything that
+            # surfaces here is a permanent failure.
+            r = _IMG_SESSION.get(main_image_url, stream=True, timeout=30)
+            r.raise_for_status()
+            with tmp:
+                # 1MB buffer instead of the 16KB default: far fewer
+                # read/write syscalls per multi-MB image.
+                shutil.copyfileobj(r.raw, tmp, length=1 << 20)
+            os.replace(tmp.name, dest_path)
+        except (requests.RequestException, OSError) as e:
+            print(f"Failed to download {main_image_url}: {e}")
+            tmp.close()
+            Path(tmp.name).unlink(missing_ok=True)
 
     return f"uploads/{dest_filename}" if dest_path.exists() else ""
 
 
+def download_main_image(product):
+    return download_image(_main_image_url(product))
+
+
 # ---------- Import products ----------
-def import_products(products):
+def import_products(products, workers=DOWNLOAD_WORKERS):
     items = []
     products_with_images = 0
-    skipped_tableau = 0
 
-    for product in products:
+    kept = [p for p in products if p.get("sub_category") != "Tableau"]
+    skipped_tableau = len(products) - len(kept)
 
-        if product.get("sub_category") == "Tableau":
-            skipped_tableau += 1
-            continue
+    # Many SKUs share a CDN image; fetch each unique URL exactly once, in
+    # parallel, then map the results back. The session from above is
+    # thread-safe for GETs.
+    urls = list({u for u in map(_main_image_url, kept) if u})
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        url_to_path = dict(zip(urls, ex.map(download_image, urls)))
 
-        # Download only the main image
-        image_path = download_main_image(product)
+    for product in kept:
+        image_path = url_to_path.get(_main_image_url(product), "")
         if image_path:
             products_with_images += 1
 
         # Empty media_gallery (since you don't want extra images)
         media_gallery = []
 
-        # Description - preserve HTML
+        # Description - strip the HTML once here (selectolax is a C-level
+        # parser) so the analyzed field holds clean text; the raw HTML is
+        # kept alongside for display.
         desc_obj = product.get("description", {})
-        description = desc_obj.get("html", "") if isinstance(desc_obj, dict) else ""
+        description_html = desc_obj.get("html", "") if isinstance(desc_obj, dict) else ""
+        description = HTMLParser(description_html).text(separator=" ").strip() if description_html else ""
+
+        attrs = _attr_map(product)
 
         # Colors
-        colors_str = get_attribute_value(product, "Colors")
+        colors_str = attrs.get("Colors", "")
         colors = [c.strip() for c in colors_str.split(",") if c.strip()] if colors_str else []
 
         # Item type
@@ -147,14 +235,14 @@ def import_products(products):
             item_type = product.get("sub_category", "")
 
         # Material
-        material = get_attribute_value(product, "Detailed Materials")
+        material = attrs.get("Detailed Materials", "")
         if not material:
             material = "Mixed"
 
         # Dimensions
-        width = get_attribute_value(product, "Width (cm)")
-        depth = get_attribute_value(product, "Depth (cm)") or get_attribute_value(product, "Length (cm)")
-        height = get_attribute_value(product, "Height (cm)")
+        width = attrs.get("Width (cm)", "")
+        depth = attrs.get("Depth (cm)", "") or attrs.get("Length (cm)", "")
+        height = attrs.get("Height (cm)", "")
         dim_parts = [v for v in [width, depth, height] if v]
         dimensions = " x ".join(f"{v} cm" for v in dim_parts) if dim_parts else ""
 
@@ -177,12 +265,16 @@ def import_products(products):
             final_price=final_price,
             image_path=image_path,
             description=description,
+            description_html=description_html,
             media_gallery=media_gallery  # Empty list
         )
 
         items.append(furniture)
 
-    repo.bulk_insert(items, refresh=True)
+    # No per-request refresh while importing; one explicit refresh at the
+    # end makes everything searchable at once.
+    with repo.suspend_refresh():
+        repo.bulk_insert(items)
     print(f"Total products processed: {len(products)}")
     print(f"Skipped Tableau products: {skipped_tableau}")
     print(f"Products with main image: {products_with_images}")
@@ -190,12 +282,34 @@ def import_products(products):
 
 
 # ---------- Main ----------
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Import the product catalog into Elasticsearch."
+    )
+    parser.add_argument(
+        "--keep-index", action="store_true",
+        help="reuse the existing index instead of recreating it",
+    )
+    parser.add_argument(
+        "--pages", type=int, default=2,
+        help="number of catalog pages to fetch (default: 2)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=DOWNLOAD_WORKERS,
+        help=f"parallel image downloads (default: {DOWNLOAD_WORKERS})",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = _parse_args()
     print(f"Using index: {INDEX}")
 
-    products = fetch_products()
+    repo.ensure_index(force=not args.keep_index)
+
+    products = fetch_products(pages=args.pages)
 
     if not products:
         print("No products fetched. Check your BASE_URL and network.")
     else:
-        import_products(products)
\ No newline at end of file
+        import_products(products, workers=args.workers)
\ No newline at end of file
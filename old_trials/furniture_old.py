@@ -128,7 +128,13 @@ class Furniture:
 
     @staticmethod
     def encode_image_from_path(image_path: str):
-        image = Image.open(image_path).convert("RGB")
+        # CLIP resizes to 224x224 internally anyway; shrink first so a
+        # 3000x3000 product photo doesn't travel through preprocessing at
+        # full resolution. Skip convert() when the image is already RGB.
+        image = Image.open(image_path)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((256, 256), Image.BILINEAR)
         emb = Furniture.model.encode(image)
         return emb.astype(float).tolist()
 
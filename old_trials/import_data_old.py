@@ -6,6 +6,8 @@ import numpy as np
 from furniture import Furniture, FurnitureRepository, Util
 from PIL import Image
 
+_DECIMAL_RE = re.compile(r"([\d.]+)")
+
 DATA_FOLDER = Path("data")
 UPLOAD_DIR = Path("static/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
@@ -15,13 +17,14 @@ INDEX = Util.get_index_name()
 repo = FurnitureRepository(es, INDEX)
 
 
-def parse_metadata(meta_path):
-    with open(meta_path, "r", encoding="utf-8") as f:
-        lines = [l.strip() for l in f.readlines() if l.strip()]
+def _parse_dimension(line):
+    match = _DECIMAL_RE.search(line)
+    return float(match.group(1)) if match else None
 
-    item_name = lines[0]
+
+def parse_metadata(meta_path):
     metadata = {
-        "item_name": item_name,
+        "item_name": "",
         "material": "unknown",
         "item_type": "",
         "width": None,
@@ -30,34 +33,46 @@ def parse_metadata(meta_path):
         "description": "",
     }
 
-    for line in lines[1:]:
-        if line.startswith("Material:"):
-            metadata["material"] = line.replace("Material:", "").strip()
-        elif line.startswith("Item_Type:"):
-            metadata["item_type"] = line.replace("Item_Type:", "").strip()
-        elif line.startswith("Width"):
-            match = re.search(r"([\d.]+)", line)
-            if match:
-                metadata["width"] = float(match.group(1))
-        elif line.startswith("Height"):
-            match = re.search(r"([\d.]+)", line)
-            if match:
-                metadata["height"] = float(match.group(1))
-        elif line.startswith("Colors:"):
-            metadata["colors"] = [c.strip() for c in line.replace("Colors:", "").split(",")]
+    # Single streaming pass: first non-empty line is the item name, the rest
+    # dispatch on the prefix before ':' instead of a startswith chain.
+    with open(meta_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if not metadata["item_name"]:
+                metadata["item_name"] = line
+                continue
+
+            key, _, value = line.partition(":")
+            key = key.strip()
+            value = value.strip()
+
+            if key == "Material":
+                metadata["material"] = value
+            elif key == "Item_Type":
+                metadata["item_type"] = value
+            elif key == "Colors":
+                metadata["colors"] = [c.strip() for c in value.split(",")]
+            elif key.startswith("Width"):
+                metadata["width"] = _parse_dimension(line) or metadata["width"]
+            elif key.startswith("Height"):
+                metadata["height"] = _parse_dimension(line) or metadata["height"]
 
     metadata["description"] = f"{metadata['material']} {metadata['item_type']}"
     return metadata
 
 
+_IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+
+
 def find_images(folder_path):
-    # Only import images named "original"
+    # Only import images named "original"; glob lets the filesystem do the
+    # name matching instead of stat-ing every entry in the folder.
     return [
         file
-        for file in folder_path.iterdir()
-        if file.is_file()
-        and file.stem.lower() == "original"
-        and file.suffix.lower() in [".jpg", ".jpeg", ".png"]
+        for file in folder_path.glob("original.*")
+        if file.suffix.lower() in _IMAGE_EXTS
     ]
 
 
@@ -71,10 +86,12 @@ def reset_index():
 
 def import_all():
     total_docs = 0
-    for folder in DATA_FOLDER.iterdir():
-        if not folder.is_dir():
-            continue
+    # scandir yields dirent type info from the directory read itself, so the
+    # is_dir check below usually costs no extra stat call.
+    with os.scandir(DATA_FOLDER) as it:
+        entries = [Path(e.path) for e in it if e.is_dir(follow_symlinks=False)]
 
+    for folder in entries:
         meta_file = folder / "metadata.txt"
         if not meta_file.exists():
             print(f"No metadata found in {folder}, skipping...")
@@ -89,7 +106,13 @@ def import_all():
         for img_path in images:
             dest_filename = f"{metadata['item_name'].replace(' ', '_')}_{img_path.name}"
             dest_path = UPLOAD_DIR / dest_filename
-            shutil.copy(img_path, dest_path)
+            if not dest_path.exists():
+                # Hardlink is a single inode op (zero bytes copied); fall back
+                # to a real copy across filesystems.
+                try:
+                    os.link(img_path, dest_path)
+                except (OSError, FileExistsError):
+                    shutil.copy2(img_path, dest_path)
 
             # Create Furniture object
             f = Furniture(
@@ -121,4 +144,5 @@ def import_all():
 
 if __name__ == "__main__":
     reset_index()
+    repo.ensure_index()
     import_all()
\ No newline at end of file